@@ -7,21 +7,31 @@ with STR genotypes generated by HipSTR.
 """
 
 import argparse
+import concurrent.futures
+import functools
+import itertools
+import math
 import numpy as np
 import os
 import sys
 import time
 
-import scipy.optimize
-from scipy.stats.distributions import chi2
-
 import trtools.utils.utils as utils
 import trtools.utils.common as common
 import trtools.utils.tr_harmonizer as trh
 from trtools import __version__
 
 ZERO = 10e-200
+LOGZERO = np.log(ZERO)
+# Added to per-read likelihoods before taking the log. This keeps the log
+# finite if a likelihood underflows to 0, and leaves any likelihood
+# above ~1e-290 bit-for-bit unchanged
+TINY = np.finfo(np.float64).tiny
 MAXSTUTTEROFFSET = 200
+# Starting value and bounds for the mosaic fraction.
+# 0.5 makes the most sense so far as the upper bound for real data
+F_INITIAL = 0.01
+F_BOUNDS = (0, 0.5)
 
 def StutterProb(delta, stutter_u, stutter_d, stutter_rho):
     r"""Compute P(r_i | genotype; error model)
@@ -53,7 +63,41 @@ def StutterProb(delta, stutter_u, stutter_d, stutter_rho):
         prob = (stutter_d)*(stutter_rho)*(pow((1-stutter_rho), (abs_delta-1)))
     return prob
 
-def MaximizeMosaicLikelihoodBoth(reads, A, B,
+@functools.lru_cache(maxsize=4096)
+def GetStutterProbs(stutter_u, stutter_d, stutter_rho):
+    r"""Compute P(r_i | genotype; error model) for every delta
+    in [-MAXSTUTTEROFFSET, MAXSTUTTEROFFSET)
+
+    Parameters
+    ----------
+    stutter_u : float
+       Probability to see an expansion stutter error
+    stutter_d : float
+       Probability to see a deletion stutter error
+    stutter_rho : float
+       Step size parameter
+
+    Returns
+    -------
+    stutter_probs : numpy.ndarray of floats
+       stutter probs for each delta. Entry delta+MAXSTUTTEROFFSET
+       gives the probability for delta, as in StutterProb.
+       Many loci share stutter parameters, so results are cached
+       and the returned array is read-only
+    """
+    deltas = np.arange(-MAXSTUTTEROFFSET, MAXSTUTTEROFFSET)
+    # rho_pow[k] = (1-rho)^k for k = 0..MAXSTUTTEROFFSET-1
+    rho_pow = np.empty(MAXSTUTTEROFFSET)
+    rho_pow[0] = 1
+    rho_pow[1:] = np.cumprod(np.full(MAXSTUTTEROFFSET-1, 1-stutter_rho))
+    step_probs = stutter_rho*rho_pow[np.maximum(np.abs(deltas)-1, 0)]
+    stutter_probs = np.where(deltas > 0, stutter_u*step_probs,
+                             np.where(deltas < 0, stutter_d*step_probs,
+                                      1 - stutter_u - stutter_d))
+    stutter_probs.flags.writeable = False
+    return stutter_probs
+
+def MaximizeMosaicLikelihoodBoth(unique_reads, read_counts, A, B,
                                  stutter_probs,
                                  maxiter=100, locname="None",
                                  quiet=False):
@@ -63,13 +107,15 @@ def MaximizeMosaicLikelihoodBoth(reads, A, B,
 
     Parameters
     ----------
-    reads : list of int
-       list of repeat lengths seen in each read
+    unique_reads : numpy.ndarray of int
+       unique repeat lengths seen across reads
+    read_counts : numpy.ndarray of int
+       number of reads supporting each entry of unique_reads
     A : int
        First allele of the genotype
     B : int
        Second allele of the genotype
-    stutter_probs : list of floats
+    stutter_probs : numpy.ndarray of floats
        stutter probs for each delta
     max_iter : int (optional)
        Maximum number of iterations to run
@@ -87,28 +133,33 @@ def MaximizeMosaicLikelihoodBoth(reads, A, B,
        Estimated mosaic fraction
     """
     # Initialize to reasonable values
-    f = 0.01
+    f = F_INITIAL
     c_prev = 0
     f_prev = 0
 
     # First predict C and F separately
-    C = Just_C_Pred(reads, A, B, f, stutter_probs)
-    f = Just_F_Pred(reads, A, B, C, stutter_probs)
+    C = Just_C_Pred(unique_reads, read_counts, A, B, f, stutter_probs)
+    f = Just_F_Pred(unique_reads, read_counts, A, B, C, stutter_probs)
 
     # Iterate between predicting C and F
     iter_num = 1
     while True:
+        if f < 0.000001:
+            # With f~0 the likelihood hardly depends on C, so another
+            # scan for C carries no information. Keeping C the f update
+            # would return the same f and meet the convergence check.
+            break
         c_prev = C
         f_prev = f
         # calling function for predicting mosaic allele value
-        C = Just_C_Pred(reads, A, B, f, stutter_probs)
+        C = Just_C_Pred(unique_reads, read_counts, A, B, f, stutter_probs)
         # calling function for predicting mosaic fraction value
-        f = Just_F_Pred(reads, A, B, C, stutter_probs)
+        f = Just_F_Pred(unique_reads, read_counts, A, B, C, stutter_probs)
         iter_num += 1
         if iter_num > maxiter:
             if not quiet:
-                common.WARNING("ML didn't converge reads=%s A=%s B=%s %s" %
-                           (str(reads), A, B, locname))
+                common.WARNING("ML didn't converge reads=%s counts=%s A=%s B=%s %s" %
+                           (str(unique_reads), str(read_counts), A, B, locname))
             break
         if abs(f-f_prev) < 0.01 and (f < 0.000001 or C == c_prev):
             break  # checking for and preventing convergence
@@ -116,20 +167,22 @@ def MaximizeMosaicLikelihoodBoth(reads, A, B,
         C = None  # stating C as None when the mosaic allele fraction is 0
     return C, f
 
-def Just_C_Pred(reads, A, B, f, stutter_probs):
+def Just_C_Pred(unique_reads, read_counts, A, B, f, stutter_probs):
     r"""Predict C, holding f constant
 
     Parameters
     ----------
-    reads : list of int
-       list of repeat lengths seen in each read
+    unique_reads : numpy.ndarray of int
+       unique repeat lengths seen across reads
+    read_counts : numpy.ndarray of int
+       number of reads supporting each entry of unique_reads
     A : int
        First allele of the genotype
     B : int
        Second allele of the genotype
     f : float
        Mosaic fraction
-    stutter_probs : list of floats
+    stutter_probs : numpy.ndarray of floats
        stutter probs for each delta
 
     Returns
@@ -137,38 +190,173 @@ def Just_C_Pred(reads, A, B, f, stutter_probs):
     C : int
        mosaic allele
     """
-    min_limit = min(reads)-3
+    min_limit = int(unique_reads.min())-3
     # max range is 3 above the min of the set of reads
-    max_limit = max(reads)+3
-    c_range = [i for i in range(min_limit, max_limit+1)]
-    max_likehood = float("-inf")
+    max_limit = int(unique_reads.max())+3
+    c_range = np.arange(min_limit, max_limit+1, dtype=np.int32)
+
+    # The germline part of the mixture does not depend on C,
+    # so only the C stutter probabilities change across the scan
+    prob_A = GetReadStutterProbs(unique_reads, A, stutter_probs)
+    prob_B = GetReadStutterProbs(unique_reads, B, stutter_probs)
+    germline_1 = (1/2)*prob_A + ((1/2)-f)*prob_B
+    germline_2 = ((1/2)-f)*prob_A + (1/2)*prob_B
+
+    # Evaluate all candidates at once, one row of reads per C
+    prob_C = GetReadStutterProbs(unique_reads[np.newaxis, :],
+                                 c_range[:, np.newaxis], stutter_probs)
+    # Both hypotheses share the same lookups, stack them as
+    # (hypothesis, C, read) and take a single log
+    germline = np.stack([germline_1, germline_2])[:, np.newaxis, :]
+    log_likehood_1, log_likehood_2 = np.log(germline + f*prob_C + TINY) @ read_counts
+    log_likehoods = np.where(log_likehood_2 > log_likehood_1,
+                             log_likehood_2, log_likehood_1)
+    log_likehoods[(c_range == A) | (c_range == B)] = read_counts.sum()*LOGZERO
+
+    # Keep the first C with the highest likelihood,
+    # ignoring any candidate whose likelihood is undefined
+    log_likehoods[np.isnan(log_likehoods)] = float("-inf")
+    best = np.argmax(log_likehoods)
+    if log_likehoods[best] == float("-inf"):
+        return 0
+    return int(c_range[best])
+
+
+def FindRoot(func, lower, upper, args=(), xtol=2e-12, maxiter=100):
+    r"""Find a root of func in [lower, upper] with Brent's method
 
-    def Likelihood_mosaic_C(c_value):
-        return Likelihood_mosaic(A, B, c_value, f, reads,
-                                 stutter_probs)
-    c_final = 0
-    for i in c_range:
-        log_likehood = Likelihood_mosaic_C(i)
-        if max_likehood < log_likehood:
-            max_likehood = log_likehood
-            c_final = i
-    return c_final
+    Parameters
+    ----------
+    func : callable
+       Function of a float, called as func(x, *args)
+    lower : float
+       Lower end of the bracketing interval
+    upper : float
+       Upper end of the bracketing interval. func(lower)
+       and func(upper) must have opposite signs
+    args : tuple (optional)
+       Extra arguments passed to func
+    xtol : float (optional)
+       Absolute tolerance on the root. Default: 2e-12
+    maxiter : int (optional)
+       Maximum number of iterations. Default: 100
 
+    Returns
+    -------
+    root : float
+       x in [lower, upper] with func(x) ~ 0
+    """
+    a, b = lower, upper
+    fa, fb = func(a, *args), func(b, *args)
+    if fa*fb > 0:
+        raise ValueError("func must have opposite signs at lower and upper")
+    if fa == 0:
+        return a
+    # b is the current estimate, a the previous one and the root
+    # is kept between b and c
+    c, fc = a, fa
+    d = e = b - a
+    for _ in range(maxiter):
+        if fb*fc > 0:
+            c, fc = a, fa
+            d = e = b - a
+        if abs(fc) < abs(fb):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+        tol = 2*np.finfo(float).eps*abs(b) + xtol/2
+        m = (c - b)/2
+        if abs(m) <= tol or fb == 0:
+            break
+        if abs(e) >= tol and abs(fa) > abs(fb):
+            # Try secant or inverse quadratic interpolation
+            s = fb/fa
+            if a == c:
+                p = 2*m*s
+                q = 1 - s
+            else:
+                q = fa/fc
+                r = fb/fc
+                p = s*(2*m*q*(q - r) - (b - a)*(r - 1))
+                q = (q - 1)*(r - 1)*(s - 1)
+            if p > 0:
+                q = -q
+            p = abs(p)
+            if 2*p < min(3*m*q - abs(tol*q), abs(e*q)):
+                e, d = d, p/q
+            else:
+                d = e = m
+        else:
+            # Fall back to bisection
+            d = e = m
+        a, fa = b, fb
+        b += d if abs(d) > tol else math.copysign(tol, m)
+        fb = func(b, *args)
+    return b
+
+def MosaicReadLikelihoods(f, prob_full, prob_shared, prob_C):
+    r"""Compute the likelihood of each unique read under the
+    hypothesis where the mosaic allele takes its fraction f
+    from one of the germline alleles
 
-def Just_F_Pred(reads, A, B, C, stutter_probs):
+    Parameters
+    ----------
+    f : float
+       Mosaic fraction
+    prob_full : numpy.ndarray of floats
+       P(r_i | allele) for the germline allele kept at 1/2
+    prob_shared : numpy.ndarray of floats
+       P(r_i | allele) for the germline allele at 1/2-f
+    prob_C : numpy.ndarray of floats
+       P(r_i | C) for the mosaic allele
+
+    Returns
+    -------
+    likelihoods : numpy.ndarray of floats
+       Likelihood of each unique read
+    """
+    return (1/2)*prob_full + ((1/2)-f)*prob_shared + f*prob_C + TINY
+
+def MosaicLikelihoodDerivative(f, prob_full, prob_shared, prob_C, read_counts):
+    r"""Compute the derivative in f of the log likelihood
+    given by MosaicReadLikelihoods
+
+    Parameters
+    ----------
+    f : float
+       Mosaic fraction
+    prob_full : numpy.ndarray of floats
+       P(r_i | allele) for the germline allele kept at 1/2
+    prob_shared : numpy.ndarray of floats
+       P(r_i | allele) for the germline allele at 1/2-f
+    prob_C : numpy.ndarray of floats
+       P(r_i | C) for the mosaic allele
+    read_counts : numpy.ndarray of int
+       number of reads supporting each unique read
+
+    Returns
+    -------
+    dlikelihood : float
+       d/df of the summed log likelihood
+    """
+    return read_counts @ ((prob_C - prob_shared)/
+                          MosaicReadLikelihoods(f, prob_full, prob_shared, prob_C))
+
+def Just_F_Pred(unique_reads, read_counts, A, B, C, stutter_probs):
     r"""Predict f, holding C constant
 
     Parameters
     ----------
-    reads : list of int
-       list of repeat lengths seen in each read
+    unique_reads : numpy.ndarray of int
+       unique repeat lengths seen across reads
+    read_counts : numpy.ndarray of int
+       number of reads supporting each entry of unique_reads
     A : int
        First allele of the genotype
     B : int
        Second allele of the genotype
     C : integer
        Mosaic allele
-    stutter_probs : list of floats
+    stutter_probs : numpy.ndarray of floats
        stutter probs for each delta
 
     Returns
@@ -176,17 +364,37 @@ def Just_F_Pred(reads, A, B, C, stutter_probs):
     f : float
        mosaic fraction
     """
-
-    def Likelihood_mosaic_f(f):
-        return (-Likelihood_mosaic(A, B, C, f[0], reads,
-                                   stutter_probs))
-
-    f_initial = np.array([0.01])
-    bound_var = ((0, 0.5),) ##changed the bounds to be more accurate of what it could be in data. 0.5 makes the most sense so far
-    result = scipy.optimize.minimize(Likelihood_mosaic_f, f_initial,
-                      method="SLSQP", options={}, bounds=bound_var)
-    f_final = result.x
-    return f_final[0]
+    if C in [A, B]:
+        # Likelihood does not depend on f, keep the starting value
+        return F_INITIAL
+    f_min, f_max = F_BOUNDS
+
+    # Under either hypothesis the per-read likelihood is linear in f,
+    # so the log likelihood is concave in f and its maximum is
+    # either at a bound or at the single root of the derivative
+    prob_A = GetReadStutterProbs(unique_reads, A, stutter_probs)
+    prob_B = GetReadStutterProbs(unique_reads, B, stutter_probs)
+    prob_C = GetReadStutterProbs(unique_reads, C, stutter_probs)
+
+    f_final = F_INITIAL
+    max_likehood = float("-inf")
+    # Consider both cases (A=1/2, B=1/2-f, C=f) or
+    # (A=1/2-f, B=1/2, C=f)
+    for prob_full, prob_shared in [(prob_A, prob_B), (prob_B, prob_A)]:
+        df_args = (prob_full, prob_shared, prob_C, read_counts)
+        if MosaicLikelihoodDerivative(f_min, *df_args) <= 0:
+            f_hyp = f_min
+        elif MosaicLikelihoodDerivative(f_max, *df_args) >= 0:
+            f_hyp = f_max
+        else:
+            f_hyp = FindRoot(MosaicLikelihoodDerivative, f_min, f_max,
+                             args=df_args)
+        log_likehood = read_counts @ np.log(MosaicReadLikelihoods(f_hyp, prob_full,
+                                                                 prob_shared, prob_C))
+        if max_likehood < log_likehood:
+            max_likehood = log_likehood
+            f_final = f_hyp
+    return float(f_final)
 
 
 def ExtractAB(trrecord):
@@ -229,22 +437,31 @@ def ExtractReadVector(mallreads, period):
     
     Returns
     -------
-    reads : list of int
-        List with one entry per read. 
+    unique_reads : numpy.ndarray of int32
+        Sorted unique repeat lengths seen across reads.
         Given in terms of difference in repeats
         from reference
+    read_counts : numpy.ndarray of int32
+        Number of reads supporting each entry of unique_reads
     """
-    reads = []
-    if mallreads is None:
-        return reads
-    for allele_data in mallreads.split(";"):
-        if "|" not in allele_data:
-            break
-        al, count = allele_data.split("|")
-        al = int(al)//period
-        count = int(count)
-        reads.extend([int(al)]*count)
-    return reads
+    pairs = []
+    if mallreads is not None:
+        for allele_data in mallreads.split(";"):
+            if "|" not in allele_data:
+                break
+            pairs.append(allele_data.split("|"))
+    if len(pairs) == 0:
+        return np.array([], dtype=np.int32), np.array([], dtype=np.int32)
+    alleles = np.fromiter((int(al)//period for al, _ in pairs),
+                          dtype=np.int32, count=len(pairs))
+    counts = np.fromiter((int(count) for _, count in pairs),
+                         dtype=np.int32, count=len(pairs))
+    # Different bp alleles can give the same number of repeats,
+    # so sum the counts over a dense range of repeat lengths
+    shift = alleles.min()
+    dense_counts = np.bincount(alleles - shift, weights=counts).astype(np.int32)
+    seen = np.flatnonzero(dense_counts)
+    return (seen + shift).astype(np.int32), dense_counts[seen]
 
 def ConfineRange(x, minval, maxval):
 	r"""Confine the range of a nmber to lie
@@ -272,22 +489,47 @@ def ConfineRange(x, minval, maxval):
 		x_cons = maxval
 	return x_cons
 
-def Likelihood_mosaic(A, B, C, f, reads, stutter_probs):
+def GetReadStutterProbs(unique_reads, allele, stutter_probs):
+    r"""Look up P(r_i | allele; error model) for each unique read
+
+    Parameters
+    ----------
+    unique_reads : numpy.ndarray of int
+       unique repeat lengths seen across reads
+    allele : int or numpy.ndarray of int
+       Underlying allele the reads are compared to.
+       Arrays are broadcast against unique_reads
+    stutter_probs : numpy.ndarray of floats
+       stutter probs for each delta
+
+    Returns
+    -------
+    probs : numpy.ndarray of floats
+       Stutter probability of each unique read given allele
+    """
+    # Deltas beyond the table get the probability of the largest delta
+    deltas = np.clip(unique_reads-allele, -MAXSTUTTEROFFSET,
+                     MAXSTUTTEROFFSET-1) + MAXSTUTTEROFFSET
+    return stutter_probs[deltas]
+
+def Likelihood_mosaic(A, B, C, f, unique_reads, read_counts, stutter_probs):
     r"""
     Compute likelihood of observing the reads, given
     true genotype=A,B and mosaic allele C, mosaic fraction f
 
     Parameters
     ----------
-    reads : list of int
-       list of repeat lengths seen in each read
+    unique_reads : numpy.ndarray of int
+       unique repeat lengths seen across reads
+    read_counts : numpy.ndarray of int
+       number of reads supporting each entry of unique_reads
     A : int
        First allele of the genotype
     B : int
        Second allele of the genotype
     C : integer
        Mosaic allele
-    stutter_probs : list of floats
+    stutter_probs : numpy.ndarray of floats
        stutter probs for each delta
     f : float
        mosaic fraction
@@ -297,42 +539,25 @@ def Likelihood_mosaic(A, B, C, f, reads, stutter_probs):
     sum_likelihood : float
         sum of max likelihood calculated for each read
     """
-    # Get dictionary of read counts
-    # e.g. [-10, -10, -10, 3, 3, 3, 3] -> {-10: 3, 3: 4}
-    rcounts = {} # r -> num. times observed
-    for r in set(reads):
-        rcounts[r] = reads.count(r)
+    if C in [A, B]:
+        # Every read gets the same negligible likelihood
+        return read_counts.sum()*LOGZERO
 
     # Compute likelihood
     # Assume C should completely come from either A or B
     # Consider both cases (A=1/2, B=1/2-f, C=f) or
     # (A=1/2-f, B=1/2, C=f)
+    prob_A = GetReadStutterProbs(unique_reads, A, stutter_probs)
+    prob_B = GetReadStutterProbs(unique_reads, B, stutter_probs)
+    if C is None:
+        # C is None when the mosaic allele fraction is 0
+        prob_C = stutter_probs[MAXSTUTTEROFFSET]
+    else:
+        prob_C = GetReadStutterProbs(unique_reads, C, stutter_probs)
+    like_li_hoods = np.stack([(1/2)*prob_A + ((1/2)-f)*prob_B + f*prob_C,
+                              ((1/2)-f)*prob_A + (1/2)*prob_B + f*prob_C])
 
-    sum_likelihood_1 = 0
-    sum_likelihood_2 = 0
-    for r in rcounts.keys():
-        delta_A = ConfineRange(r-A, -100, 100)
-        delta_B = ConfineRange(r-B, -100, 100)
-
-        count = rcounts[r]
-        if C in [A, B]:
-            like_li_hood_1 = ZERO
-            like_li_hood_2 = ZERO
-        else:
-            if C is None:
-                C = 0
-                delta_C = 0 # C is None when the mosaic allele fraction is 0
-            else:
-                delta_C = ConfineRange(r-C, -100, 100)
-            like_li_hood_1 = (1/2)*stutter_probs[delta_A+MAXSTUTTEROFFSET] + \
-                           ((1/2)-f)*stutter_probs[delta_B+MAXSTUTTEROFFSET] + \
-                           (f)*stutter_probs[delta_C+MAXSTUTTEROFFSET]
-            like_li_hood_2 = ((1/2)-f)*stutter_probs[delta_A+MAXSTUTTEROFFSET] + \
-                           (1/2)*stutter_probs[delta_B+MAXSTUTTEROFFSET] + \
-                           (f)*stutter_probs[delta_C+MAXSTUTTEROFFSET]
-        
-        sum_likelihood_1 = sum_likelihood_1 + count*np.log(like_li_hood_1)
-        sum_likelihood_2 = sum_likelihood_2 + count*np.log(like_li_hood_2)
+    sum_likelihood_1, sum_likelihood_2 = np.log(like_li_hoods + TINY) @ read_counts
 
     sum_likelihood = max(sum_likelihood_1, sum_likelihood_2)
     return sum_likelihood
@@ -354,13 +579,15 @@ def SF(x):
 	if x <= 0: sf = 1
 	return sf
 
-def ComputePvalue(reads, A, B, best_C, best_f, stutter_probs):
+def ComputePvalue(unique_reads, read_counts, A, B, best_C, best_f, stutter_probs):
 	r"""Compute pvalue testing H0:f=0
 
 	Parameters
 	----------
-	reads : list of int
-		list of repeat lengths seen in each read
+	unique_reads : numpy.ndarray of int
+		unique repeat lengths seen across reads
+	read_counts : numpy.ndarray of int
+		number of reads supporting each entry of unique_reads
 	A : int
 		First allele of the genotype
 	B : int
@@ -369,7 +596,7 @@ def ComputePvalue(reads, A, B, best_C, best_f, stutter_probs):
 		Estimated mosaic allele
 	best_f : float
 		mosaic fraction
-	stutter_probs : list of floats
+	stutter_probs : numpy.ndarray of floats
 		stutter probs for each delta
 
 	Returns
@@ -377,13 +604,63 @@ def ComputePvalue(reads, A, B, best_C, best_f, stutter_probs):
 	pval : float
 		P-value testing H0: f=0
 	"""
-	log_obs = Likelihood_mosaic(A, B, best_C, best_f, reads, stutter_probs)
-	log_exp = Likelihood_mosaic(A, B, best_C, 0, reads, stutter_probs)
+	log_obs = Likelihood_mosaic(A, B, best_C, best_f, unique_reads, read_counts, stutter_probs)
+	log_exp = Likelihood_mosaic(A, B, best_C, 0, unique_reads, read_counts, stutter_probs)
 	test_stat = -2*(log_exp-log_obs)
-	pval = 0.5*SF(test_stat) + 0.5*chi2.sf(test_stat, 2)
+	# Mixture of a point mass at 0 (see SF) and chi2 with 2 degrees
+	# of freedom, whose survival function is exp(-x/2)
+	point_sf = 1.0 if test_stat <= 0 else 0.0
+	pval = 0.5*point_sf + 0.5*math.exp(-0.5*max(test_stat, 0.0))
 	#pval = 1 - scipy.stats.chi2.cdf(test_stat, 1)
 	return pval
 
+def ProcessSample(unique_reads, read_counts, A, B,
+                  stutter_u, stutter_d, stutter_rho,
+                  locname="None", quiet=False):
+    r"""Estimate C and f for one sample and test H0:f=0
+
+    The stutter table is looked up from the stutter parameters
+    with GetStutterProbs, which caches it. When samples are sent
+    to worker processes only the three parameters are passed and
+    each worker builds the table once per set of parameters.
+
+    Parameters
+    ----------
+    unique_reads : numpy.ndarray of int
+       unique repeat lengths seen across reads
+    read_counts : numpy.ndarray of int
+       number of reads supporting each entry of unique_reads
+    A : int
+       First allele of the genotype
+    B : int
+       Second allele of the genotype
+    stutter_u : float
+       Probability to see an expansion stutter error
+    stutter_d : float
+       Probability to see a deletion stutter error
+    stutter_rho : float
+       Step size parameter
+    locname : str (optional)
+       String identifier of the locus. For
+       warning message purposes. Default: "None"
+    quiet : bool
+       Don't print out any messages
+
+    Returns
+    -------
+    best_C : int
+       Estimated mosaic allele
+    best_f : float
+       Estimated mosaic fraction
+    pval : float
+       P-value testing H0: f=0
+    """
+    stutter_probs = GetStutterProbs(stutter_u, stutter_d, stutter_rho)
+    best_C, best_f = MaximizeMosaicLikelihoodBoth(unique_reads, read_counts, A, B, stutter_probs,
+                                                  locname=locname, quiet=quiet)
+    pval = ComputePvalue(unique_reads, read_counts, A, B, best_C, best_f, stutter_probs)
+    return best_C, best_f, pval
+
 def getargs(): # pragma: no cover
     parser = argparse.ArgumentParser(
         __doc__,
@@ -412,6 +689,8 @@ def getargs(): # pragma: no cover
         "--debug", help="Print helpful debug messages", action="store_true")
     other_group.add_argument(
     	"--quiet", help="Don't print messages to the screen", action="store_true")
+    other_group.add_argument(
+        "--threads", help="Number of processes to use for testing samples", type=int, default=1)
     ver_group = parser.add_argument_group("Version")
     ver_group.add_argument("--version", action="version",
                            version='{version}'.format(version=__version__))
@@ -435,6 +714,9 @@ def main(args):
     if args.readfield not in ["ALLREADS","MALLREADS"]:
         common.WARNING("Error: args.readfield must be either ALLREADS or MALLREADS")
         return 1
+    if args.threads < 1:
+        common.WARNING("Error: --threads must be at least 1")
+        return 1
 
     checkgz = args.region is not None
     invcf = utils.LoadSingleReader(args.vcf, checkgz=checkgz)
@@ -465,7 +747,7 @@ def main(args):
     if args.out == "stdout":
         outf = sys.stdout
     else:
-        outf = open(args.out + ".tab", "w")
+        outf = open(args.out + ".tab", "w", buffering=1<<20)
 
     # Header
     header_cols = ["sample", "chrom", "pos", "locus", "motif",
@@ -475,6 +757,12 @@ def main(args):
                     "quality factor", "read depth"]
     outf.write("\t".join(header_cols)+"\n")
 
+    # Samples at each record are tested in parallel if requested
+    if args.threads > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.threads)
+    else:
+        executor = None
+
     start_time = time.time()
     nrecords = 0 # Number STRs processed
     ntests = 0 # Number total tests
@@ -516,8 +804,8 @@ def main(args):
                 stutter_d = 0.01
             if stutter_rho == 1.0:
                 stutter_rho = 0.95
-        stutter_probs = [StutterProb(d, stutter_u, stutter_d, stutter_rho) \
-            for d in range(-MAXSTUTTEROFFSET, MAXSTUTTEROFFSET)]
+        # The stutter table itself is built (and cached) by
+        # ProcessSample, so workers only receive these three values
         period = len(trrecord.motif)
 
         # Array of (A,B) for each sample
@@ -525,7 +813,7 @@ def main(args):
         # these get converted to repeat units below
         genotypes = ExtractAB(trrecord)
 
-        # Array of "reads" vectors for each sample
+        # Array of (unique reads, read counts) for each sample
         # given in repeat units diff from ref
         mallreads = [ExtractReadVector(item, period)
                     for item in trrecord.format[args.readfield]]
@@ -537,53 +825,75 @@ def main(args):
         DP = trrecord.format['DP']
 
         ########### Run detection on each sample #######
+        sample_tests = [] # (sample index, unique reads, read counts, A, B, q, dp)
         for i in range(len(samples)):
             if args.samples is not None and samples[i] not in usesamples: continue
-            reads = mallreads[i]
+            unique_reads, read_counts = mallreads[i]
             A, B = genotypes[i]
             q = Q[i][0]
             dp = DP[i][0]
             # for cases where there is no DP and it gets picked up as a random negative number
             if dp < 0:
                 dp = 0
-            if A is None or B is None or len(reads) == 0:
+            if A is None or B is None or unique_reads.size == 0:
                 continue  # skip locus if not called
             A, B = A//period, B//period
             if args.debug:
                 common.WARNING("Checking mosaicism for sample %s at %s" % (
                     samples[i], str(trrecord)))
-                common.WARNING("A=%s B=%s reads=%s" % (A, B, str(reads)))
+                common.WARNING("A=%s B=%s reads=%s counts=%s" % (A, B,
+                    str(unique_reads), str(read_counts)))
 
             # Discard locus if: no evidence for called genotypes
-            if A not in reads or B not in reads and not args.output_all:
+            A_seen = bool((unique_reads == A).any())
+            B_seen = bool((unique_reads == B).any())
+            if not A_seen or not B_seen and not args.output_all:
                 continue
             # Discard locus if: only a single allele seen in the reads
-            if len(set(reads)) == 1 and not args.output_all:
+            if unique_reads.size == 1 and not args.output_all:
                 continue
             ntests += 1
-            locname = "%s:%s" % (record.CHROM, record.POS)
-            best_C, best_f = MaximizeMosaicLikelihoodBoth(reads, A, B, stutter_probs,
-                                                            locname=locname, quiet=not(args.debug))
-            pval = ComputePvalue(reads, A, B, best_C, best_f, stutter_probs)
-
-            outf.write('\t'.join([samples[i], record.CHROM, str(record.POS),
-                                    str(record.ID), trrecord.motif, str(
-                                        A), str(B),
-                                    str(best_C), str(best_f), str(pval),
-                                    trrecord.format[args.readfield][i],
-                                    str(reads.count(best_C)),
-                                    str(stutter_u), str(
-                                        stutter_d), str(stutter_rho),
-                                    str(q), str(dp)]) + '\n')
+            sample_tests.append((i, unique_reads, read_counts, A, B, q, dp))
+
+        locname = "%s:%s" % (record.CHROM, record.POS)
+        sample_args = [[test[1] for test in sample_tests],
+                       [test[2] for test in sample_tests],
+                       [test[3] for test in sample_tests],
+                       [test[4] for test in sample_tests],
+                       itertools.repeat(stutter_u),
+                       itertools.repeat(stutter_d),
+                       itertools.repeat(stutter_rho),
+                       itertools.repeat(locname),
+                       itertools.repeat(not(args.debug))]
+        if executor is None:
+            results = map(ProcessSample, *sample_args)
+        else:
+            chunksize = max(1, len(sample_tests)//(4*args.threads))
+            results = executor.map(ProcessSample, *sample_args, chunksize=chunksize)
+
+        rows = []
+        for (i, unique_reads, read_counts, A, B, q, dp), (best_C, best_f, pval) in \
+                zip(sample_tests, results):
+            mosaic_support = int(read_counts[unique_reads==best_C].sum())
+            # q and dp are numpy scalars from the FORMAT arrays, use
+            # str() for them to get the same text as the VCF values
+            rows.append(f"{samples[i]}\t{record.CHROM}\t{record.POS}\t{record.ID}\t"
+                        f"{trrecord.motif}\t{A}\t{B}\t{best_C}\t{best_f}\t{pval}\t"
+                        f"{trrecord.format[args.readfield][i]}\t{mosaic_support}\t"
+                        f"{stutter_u}\t{stutter_d}\t{stutter_rho}\t{q!s}\t{dp!s}\n")
             if args.debug:
                 common.WARNING("Inferred best_C=%s best_f=%s" %
                                 (best_C, best_f))
-        
+        outf.writelines(rows)
+
         if nrecords > 0 and nrecords % 50 == 0 and not args.quiet:
             common.MSG("Finished {} records, {} total tests. "
                 " time/record={:.5}sec".format(nrecords, ntests,
                 (time.time() - start_time)/nrecords), debug=True)
     
+    if executor is not None:
+        executor.shutdown()
+
     if not args.quiet:
         common.MSG("Performed analysis on {} records, {} total tests".format(nrecords, ntests), debug=True)
 
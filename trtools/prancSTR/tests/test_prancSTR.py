@@ -1,7 +1,9 @@
 import argparse
 import os
 
+import numpy as np
 import pytest
+import scipy.stats
 
 from ..prancSTR import *
 
@@ -19,6 +21,7 @@ def args(tmpdir):
     args.quiet = True
     args.output_all = False
     args.readfield = "MALLREADS"
+    args.threads = 1
     return args
 
 # Test no such file or directory
@@ -126,6 +129,25 @@ def test_MosaicCase(args, vcfdir):
 
 
 
+# Test running samples in parallel
+def test_Threads(args, vcfdir, tmpdir):
+    fname = os.path.join(vcfdir, "CEU_test.vcf.gz")
+    args.vcf = fname
+    args.out = str(tmpdir / "serial")
+    retcode = main(args)
+    assert retcode==0
+
+    args.threads = 2
+    args.out = str(tmpdir / "parallel")
+    retcode = main(args)
+    assert retcode==0
+    with open(str(tmpdir / "serial.tab")) as f1, open(str(tmpdir / "parallel.tab")) as f2:
+        assert f1.read() == f2.read()
+
+    args.threads = 0
+    retcode = main(args)
+    assert retcode==1
+
 # Test the probability of observing a certain repeat length
 def test_StutterProb1():
     delta = 0
@@ -167,16 +189,32 @@ def test_StutterProb5():
     expected_prob = stutter_d * stutter_rho * (pow((1 - stutter_rho), (abs(delta) - 1)))
     assert StutterProb(delta, stutter_u, stutter_d, stutter_rho) == expected_prob
 
+def test_GetStutterProbs():
+    stutter_u = 0.1
+    stutter_d = 0.05
+    stutter_rho = 0.2
+    stutter_probs = GetStutterProbs(stutter_u, stutter_d, stutter_rho)
+    assert stutter_probs.shape == (2*MAXSTUTTEROFFSET,)
+    expected_probs = [StutterProb(d, stutter_u, stutter_d, stutter_rho) \
+        for d in range(-MAXSTUTTEROFFSET, MAXSTUTTEROFFSET)]
+    np.testing.assert_allclose(stutter_probs, expected_probs, rtol=1e-12)
+    assert stutter_probs[MAXSTUTTEROFFSET] == 1 - stutter_u - stutter_d
+
+    # Tables are cached and shared between loci
+    assert GetStutterProbs(stutter_u, stutter_d, stutter_rho) is stutter_probs
+    assert not stutter_probs.flags.writeable
+
 #Test the values of C and f
 def test_MaximizeMosaicLikelihoodBoth1():
     reads = [10, 11, 10, 11, 10]
     A = 9
     B = 12
-    stutter_probs = [x * 0.001 for x in range(-200, 201)]
+    stutter_probs = np.array([x * 0.001 for x in range(-200, 201)])
     maxiter = 100
     locname = "None"
     quiet = True
-    C, f = MaximizeMosaicLikelihoodBoth(reads, A, B, stutter_probs, maxiter, locname, quiet)
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    C, f = MaximizeMosaicLikelihoodBoth(unique_reads, read_counts, A, B, stutter_probs, maxiter, locname, quiet)
     assert C == 9
     assert f == 0.01
 
@@ -184,11 +222,12 @@ def test_MaximizeMosaicLikelihoodBoth2():
     reads = [-3, -3, -3, -3, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2]
     A = -2
     B = -2
-    stutter_probs = [x * 0.001 for x in range(-200, 201)]
+    stutter_probs = np.array([x * 0.001 for x in range(-200, 201)])
     maxiter = 100
     locname = "None"
     quiet = True
-    C, f = MaximizeMosaicLikelihoodBoth(reads, A, B, stutter_probs, maxiter, locname, quiet)
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    C, f = MaximizeMosaicLikelihoodBoth(unique_reads, read_counts, A, B, stutter_probs, maxiter, locname, quiet)
     assert C == -2
     assert f== 0.01
 
@@ -196,11 +235,12 @@ def test_MaximizeMosaicLikelihoodBoth3():
     reads = [-5, -5, -4, -4, -3, -3, -2, -2, -1, -1]
     A = -5
     B = -1
-    stutter_probs = [x * 0.001 for x in range(-200, 201)]
+    stutter_probs = np.array([x * 0.001 for x in range(-200, 201)])
     maxiter = 100
     locname = "None"
     quiet = True
-    C, f = MaximizeMosaicLikelihoodBoth(reads, A, B, stutter_probs, maxiter, locname, quiet)
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    C, f = MaximizeMosaicLikelihoodBoth(unique_reads, read_counts, A, B, stutter_probs, maxiter, locname, quiet)
     assert C == -5
     assert f == pytest.approx(0.0167, abs=1e-2)
 
@@ -208,26 +248,42 @@ def test_MaximizeMosaicLikelihoodBoth3():
 def test_ExtractReadVector1():
     mallreads=None
     period=3
-    reads=ExtractReadVector(mallreads, period)
-    assert reads==[]
+    unique_reads, read_counts=ExtractReadVector(mallreads, period)
+    assert unique_reads.size==0 and read_counts.size==0
 
 def test_ExtractReadVector2():
     mallreads="-6|4;-4|28"
     period=1
-    reads=ExtractReadVector(mallreads, period)
-    assert reads==[-6, -6, -6, -6, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4]
+    unique_reads, read_counts=ExtractReadVector(mallreads, period)
+    assert list(unique_reads)==[-6, -4]
+    assert list(read_counts)==[4, 28]
 
 def test_ExtractReadVector3():
     mallreads="9|3;10|5;11|2"
     period=1
-    reads=ExtractReadVector(mallreads, period)
-    assert reads ==[9, 9, 9, 10, 10, 10, 10, 10, 11, 11]
+    unique_reads, read_counts=ExtractReadVector(mallreads, period)
+    assert list(unique_reads)==[9, 10, 11]
+    assert list(read_counts)==[3, 5, 2]
 
 def test_ExtractReadVector4():
     mallreads="-12|9;-4|16;0|29;4|11"
     period=2
-    reads=ExtractReadVector(mallreads, period)
-    assert reads ==[-6, -6, -6, -6, -6, -6, -6, -6, -6, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, -2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2]
+    unique_reads, read_counts=ExtractReadVector(mallreads, period)
+    assert list(unique_reads)==[-6, -2, 0, 2]
+    assert list(read_counts)==[9, 16, 29, 11]
+
+def test_ExtractReadVector5():
+    # Alleles that are not a multiple of the period
+    # are collapsed into the same repeat length
+    mallreads="-6|3;-5|2;1|4"
+    period=2
+    unique_reads, read_counts=ExtractReadVector(mallreads, period)
+    assert list(unique_reads)==[-3, 0]
+    assert list(read_counts)==[5, 4]
+
+    mallreads="."
+    unique_reads, read_counts=ExtractReadVector(mallreads, period)
+    assert unique_reads.size==0 and read_counts.size==0
 
 # Test minimum and maximum values of a number
 def test_ConfineRange1():
@@ -242,6 +298,14 @@ def test_ConfineRange3():
     x_cons=ConfineRange(45, 40, 50)
     assert x_cons==45
 
+#Test the stutter probability lookup for each read
+def test_GetReadStutterProbs():
+    stutter_probs = GetStutterProbs(0.1, 0.05, 0.2)
+    unique_reads = np.array([-500, -3, 0, 2, 199, 500], dtype=np.int32)
+    probs = GetReadStutterProbs(unique_reads, 0, stutter_probs)
+    expected_probs = [StutterProb(d, 0.1, 0.05, 0.2) for d in [-200, -3, 0, 2, 199, 199]]
+    np.testing.assert_allclose(probs, expected_probs, rtol=1e-12)
+
 #Test the likelihood of observing the reads
 def test_Likelihood_mosaic1():
     reads = [10, 11, 10, 11, 10]
@@ -249,8 +313,9 @@ def test_Likelihood_mosaic1():
     B = 12
     C = 9
     f = 0.01
-    stutter_probs = [x * 0.001 for x in range(-100, 101)]
-    result_likelihood = Likelihood_mosaic(A, B, C, f, reads, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 101)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    result_likelihood = Likelihood_mosaic(A, B, C, f, unique_reads, read_counts, stutter_probs)
     assert -2300 <= result_likelihood <= -2290
 
 def test_Likelihood_mosaic2():
@@ -259,8 +324,9 @@ def test_Likelihood_mosaic2():
     B = -2
     C = -2
     f = 0.01
-    stutter_probs = [x * 0.001 for x in range(-100, 101)]
-    result_likelihood = Likelihood_mosaic(A, B, C, f, reads, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 101)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    result_likelihood = Likelihood_mosaic(A, B, C, f, unique_reads, read_counts, stutter_probs)
     assert -15000 <= result_likelihood <= -14000 
 
 def test_Likelihood_mosaic3():
@@ -269,10 +335,24 @@ def test_Likelihood_mosaic3():
     B = -1
     C = -5
     f = pytest.approx(0.0167, 1e-2)
-    stutter_probs = [x * 0.001 for x in range(-100, 100)]
-    result_likelihood = Likelihood_mosaic(A, B, C, f, reads, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 100)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    result_likelihood = Likelihood_mosaic(A, B, C, f, unique_reads, read_counts, stutter_probs)
     assert -4600 <= result_likelihood <= -4550     
 
+def test_Likelihood_mosaic4():
+    # Reads far from every allele have a stutter probability
+    # that underflows to 0, the likelihood should stay finite
+    reads = [0, 0, 1, 1, 150]
+    A = 0
+    B = 1
+    C = 2
+    f = 0.1
+    stutter_probs = GetStutterProbs(0.01, 0.01, 0.9999)
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    result_likelihood = Likelihood_mosaic(A, B, C, f, unique_reads, read_counts, stutter_probs)
+    assert np.isfinite(result_likelihood)
+
 #Test the survival function of a point mass at 0
 def test_SF1():
     x=10
@@ -295,8 +375,9 @@ def test_Just_C_Pred1():
     A = 9
     B = 12
     f = 0.01
-    stutter_probs = [x * 0.001 for x in range(-200, 201)]
-    C = Just_C_Pred(reads, A, B, f, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-200, 201)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    C = Just_C_Pred(unique_reads, read_counts, A, B, f, stutter_probs)
     assert C == 9
 
 def test_Just_C_Pred2():    
@@ -304,8 +385,9 @@ def test_Just_C_Pred2():
     A = -2
     B = -2
     f = 0.0362320
-    stutter_probs = [x * 0.001 for x in range(-200, 201)]
-    C = Just_C_Pred(reads, A, B, f, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-200, 201)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    C = Just_C_Pred(unique_reads, read_counts, A, B, f, stutter_probs)
     assert C == -2
 
 def test_Just_C_Pred3():    
@@ -313,18 +395,37 @@ def test_Just_C_Pred3():
     A = -5
     B = -1
     f = 0.0167
-    stutter_probs = [x * 0.001 for x in range(-200, 201)]
-    C = Just_C_Pred(reads, A, B, f, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-200, 201)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    C = Just_C_Pred(unique_reads, read_counts, A, B, f, stutter_probs)
     assert C == -5
 
+#Test the root finder used for the f prediction
+def test_FindRoot():
+    root = FindRoot(lambda x: x**2 - 2, 0, 2)
+    assert root == pytest.approx(np.sqrt(2), abs=1e-10)
+
+    root = FindRoot(lambda x, y: np.cos(x) - y*x, 0, 1, args=(1,))
+    assert root == pytest.approx(0.7390851332151607, abs=1e-10)
+
+    root = FindRoot(lambda x: 1/(1+x) - 0.9, 0.5, 0)
+    assert root == pytest.approx(1/9, abs=1e-10)
+
+    assert FindRoot(lambda x: x - 0.5, 0.5, 1) == 0.5
+    assert FindRoot(lambda x: x - 1, 0.5, 1) == pytest.approx(1)
+
+    with pytest.raises(ValueError):
+        FindRoot(lambda x: x**2 + 1, -1, 1)
+
 #Test the f prediction
 def test_Just_F_Pred1():
     reads = [10, 11, 10, 11, 10]
     A = 9
     B = 12
     C = 9
-    stutter_probs = [x * 0.001 for x in range(-100, 101)]
-    f = Just_F_Pred(reads, A, B, C, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 101)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    f = Just_F_Pred(unique_reads, read_counts, A, B, C, stutter_probs)
     assert f == 0.01
 
 def test_Just_F_Pred2():
@@ -332,8 +433,9 @@ def test_Just_F_Pred2():
     A = -2
     B = -2
     C = -2 
-    stutter_probs = [x * 0.001 for x in range(-100, 101)]
-    f = Just_F_Pred(reads, A, B, C, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 101)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    f = Just_F_Pred(unique_reads, read_counts, A, B, C, stutter_probs)
     assert f == pytest.approx(0.036, abs=1e-1)
 
 def test_Just_F_Pred3():
@@ -341,10 +443,29 @@ def test_Just_F_Pred3():
     A = -5
     B = -1
     C = -5 
-    stutter_probs = [x * 0.001 for x in range(-100, 101)]
-    f = Just_F_Pred(reads, A, B, C, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 101)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    f = Just_F_Pred(unique_reads, read_counts, A, B, C, stutter_probs)
     assert f == pytest.approx(0.0167, abs=1e-2)
 
+def test_Just_F_Pred4():
+    reads = [0]*20 + [2]*18 + [5]*4
+    A = 0
+    B = 2
+    C = 5
+    stutter_probs = np.array([StutterProb(d, 0.01, 0.01, 0.95) for d in range(-200, 200)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    f = Just_F_Pred(unique_reads, read_counts, A, B, C, stutter_probs)
+    # Compare to a brute force search over f
+    f_grid = np.linspace(0, 0.5, 50001)
+    likelihoods = [Likelihood_mosaic(A, B, C, x, unique_reads, read_counts, stutter_probs) for x in f_grid]
+    assert f == pytest.approx(f_grid[np.argmax(likelihoods)], abs=1e-4)
+
+    # No reads support C
+    C = 8
+    f = Just_F_Pred(unique_reads, read_counts, A, B, C, stutter_probs)
+    assert f == 0
+
 #
 def test_ComputePvalue1():
     reads = [10, 11, 10, 11, 10]
@@ -352,8 +473,9 @@ def test_ComputePvalue1():
     B = 12
     best_C = 9
     best_f = 0.01
-    stutter_probs = [x * 0.001 for x in range(-100, 101)]
-    pval = ComputePvalue(reads, A, B, best_C, best_f, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 101)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    pval = ComputePvalue(unique_reads, read_counts, A, B, best_C, best_f, stutter_probs)
     assert pval == 1
 
 def test_ComputePvalue2():
@@ -362,8 +484,9 @@ def test_ComputePvalue2():
     B = -2
     best_C = -2
     best_f = 0.0362320
-    stutter_probs = [x * 0.001 for x in range(-100, 101)]
-    pval = ComputePvalue(reads, A, B, best_C, best_f, stutter_probs)
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 101)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    pval = ComputePvalue(unique_reads, read_counts, A, B, best_C, best_f, stutter_probs)
     assert pval == 1
 
 def test_ComputePvalue3():
@@ -372,6 +495,21 @@ def test_ComputePvalue3():
     B = -1
     best_C = -5
     best_f = 0.0167
-    stutter_probs = [x * 0.001 for x in range(-100, 101)]
-    pval = ComputePvalue(reads, A, B, best_C, best_f, stutter_probs)
-    assert pval == 1
\ No newline at end of file
+    stutter_probs = np.array([x * 0.001 for x in range(-100, 101)])
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    pval = ComputePvalue(unique_reads, read_counts, A, B, best_C, best_f, stutter_probs)
+    assert pval == 1
+
+def test_ComputePvalue4():
+    reads = [0]*20 + [2]*18 + [5]*4
+    A = 0
+    B = 2
+    stutter_probs = GetStutterProbs(0.01, 0.01, 0.95)
+    unique_reads, read_counts = np.unique(reads, return_counts=True)
+    best_C, best_f = MaximizeMosaicLikelihoodBoth(unique_reads, read_counts, A, B, stutter_probs)
+    pval = ComputePvalue(unique_reads, read_counts, A, B, best_C, best_f, stutter_probs)
+    log_obs = Likelihood_mosaic(A, B, best_C, best_f, unique_reads, read_counts, stutter_probs)
+    log_exp = Likelihood_mosaic(A, B, best_C, 0, unique_reads, read_counts, stutter_probs)
+    test_stat = -2*(log_exp-log_obs)
+    assert test_stat > 0
+    assert pval == pytest.approx(0.5*scipy.stats.chi2.sf(test_stat, 2))